@@ -0,0 +1,360 @@
+import os
+import json
+import time
+import argparse
+from glob import glob
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from PIL import Image
+import httpx
+from tenacity import Retrying, stop_after_attempt, wait_exponential, retry_if_exception
+from src.tutor_engine import (
+    get_ai_feedback,
+    get_mistral_client,
+    find_relevant_pages,
+    build_retrieval_query,
+)
+
+# --- CONFIGURATION ---
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+# Pixtral 12B list price in USD per million tokens (input and output are billed the same).
+DEFAULT_PRICE_PER_MILLION_TOKENS = 0.15
+
+# Rate limits (HTTP 429), server errors (5xx) and network errors are retried with
+# exponential backoff. Other errors, e.g. a bad API key (401), fail straight away.
+MAX_ATTEMPTS = 4
+RETRY_BACKOFF_SECONDS = 2
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+# --- LOADING HELPERS ---
+def load_paper(paper_path):
+    """
+    Loads an exam paper JSON from data/processed and returns {question_id: question}.
+    Some papers reuse an id for each part of a question (e.g. q1 for parts (a), (b) and (c));
+    those parts are numbered in paper order as q1_1, q1_2, q1_3.
+    """
+    with open(paper_path, "r") as f:
+        paper_data = json.load(f)
+    paper_questions = [q for q in paper_data.get("questions", []) if q.get("id")]
+
+    id_counts = Counter(q["id"] for q in paper_questions)
+    repeated = sorted(q_id for q_id, count in id_counts.items() if count > 1)
+    if repeated:
+        print(f"Repeated question ids in {paper_path}: {', '.join(repeated)}. "
+              f"Name attempts <id>_<part>.png, e.g. {repeated[0]}_1.png.")
+
+    questions = {}
+    part_numbers = Counter()
+    for q in paper_questions:
+        q_id = q["id"]
+        if id_counts[q_id] > 1:
+            part_numbers[q_id] += 1
+            q_id = f"{q_id}_{part_numbers[q_id]}"
+        if q_id in questions:
+            raise ValueError(f"Question id '{q_id}' in {paper_path} is ambiguous after numbering repeated ids.")
+        questions[q_id] = q
+    return questions
+
+
+def collect_submissions(attempts_dir, questions):
+    """
+    Finds attempt images laid out as <attempts_dir>/<student_id>/<question_id>.png.
+    Images whose file name does not match a question id in the paper are skipped, as are
+    extra images for a question a student already has an attempt for (e.g. q1.png and q1.jpg).
+    """
+    submissions = []
+    seen = set()
+    for student_dir in sorted(glob(os.path.join(attempts_dir, "*"))):
+        if not os.path.isdir(student_dir):
+            continue
+        student_id = os.path.basename(student_dir)
+        for image_path in sorted(glob(os.path.join(student_dir, "*"))):
+            question_id, ext = os.path.splitext(os.path.basename(image_path))
+            if ext.lower() not in IMAGE_EXTENSIONS:
+                continue
+            if question_id not in questions:
+                print(f"Skipping {image_path}: no question '{question_id}' in this paper.")
+                continue
+            if (student_id, question_id) in seen:
+                print(f"Skipping {image_path}: {student_id} already has an attempt for '{question_id}'.")
+                continue
+            seen.add((student_id, question_id))
+            submissions.append({
+                "student_id": student_id,
+                "question_id": question_id,
+                "image_path": image_path,
+            })
+    return submissions
+
+
+def load_completed(output_path):
+    """Reads an existing results file and returns the (student, question) pairs already graded."""
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A partially written last line from an interrupted run
+                continue
+            if record.get("status") == "ok":
+                completed.add((record["student_id"], record["question_id"]))
+    return completed
+
+
+def compact_results(output_path):
+    """
+    Rewrites the results file with one record per (student, question), keeping the latest,
+    so submissions re-graded on a later run do not leave their old error records behind.
+    """
+    latest = {}
+    with open(output_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            key = (record["student_id"], record["question_id"])
+            latest.pop(key, None)
+            latest[key] = record
+
+    temp_path = output_path + ".tmp"
+    with open(temp_path, "w") as f:
+        for record in latest.values():
+            f.write(json.dumps(record) + "\n")
+    os.replace(temp_path, output_path)
+
+
+# --- GRADING ---
+def is_transient_error(exc):
+    """Returns True for API errors that are worth retrying."""
+    if isinstance(exc, httpx.TransportError):
+        return True
+    return getattr(exc, "status_code", None) in RETRY_STATUS_CODES
+
+
+def api_retrying():
+    return Retrying(
+        stop=stop_after_attempt(MAX_ATTEMPTS),
+        wait=wait_exponential(multiplier=RETRY_BACKOFF_SECONDS, max=60),
+        retry=retry_if_exception(is_transient_error),
+        reraise=True,
+    )
+
+
+def estimate_cost(usage, price_per_million_tokens):
+    """Estimates the cost of a chat call from its usage (retrieval embeddings are not counted)."""
+    if not usage:
+        return 0.0
+    total_tokens = usage["prompt_tokens"] + usage["completion_tokens"]
+    return total_tokens * price_per_million_tokens / 1_000_000
+
+
+def retrieve_pages(question, client):
+    """
+    Finds the textbook pages for a question, retrying transient API errors.
+    Returns the exception instead of pages if the lookup still fails.
+    """
+    try:
+        return api_retrying()(
+            find_relevant_pages, build_retrieval_query(question.get("text", "")), client,
+            raise_errors=True,
+        )
+    except Exception as e:
+        return e
+
+
+def grade_submission(submission, question, relevant_pages, client, price_per_million_tokens):
+    """Runs one attempt image through get_ai_feedback and returns a result record."""
+    start = time.perf_counter()
+    if isinstance(relevant_pages, Exception):
+        # Without the textbook context the feedback would not follow the textbook's methods
+        return {
+            "student_id": submission["student_id"],
+            "question_id": submission["question_id"],
+            "image_path": submission["image_path"],
+            "status": "error",
+            "feedback": f"Error retrieving textbook pages: {relevant_pages}",
+        }
+
+    with Image.open(submission["image_path"]) as img:
+        image = img.convert("RGB")
+
+    try:
+        feedback, pages, usage = api_retrying()(
+            get_ai_feedback, image, question.get("text", ""), client,
+            relevant_pages=relevant_pages, return_usage=True, raise_errors=True,
+        )
+    except Exception as e:
+        print(f"Mistral API Error for {submission['image_path']}: {e}")
+        feedback, pages, usage = f"Error getting AI feedback: {str(e)}", [], None
+
+    return {
+        "student_id": submission["student_id"],
+        "question_id": submission["question_id"],
+        "image_path": submission["image_path"],
+        "status": "ok" if usage is not None else "error",
+        "feedback": feedback,
+        "pages": [page["page_number"] for page in pages],
+        "usage": usage,
+        "cost_usd": estimate_cost(usage, price_per_million_tokens),
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def run_batch(paper_path, attempts_dir, output_path, client, max_workers=4,
+              price_per_million_tokens=DEFAULT_PRICE_PER_MILLION_TOKENS):
+    """
+    Grades every attempt image against its question, streaming one JSON line per submission
+    to `output_path`. Submissions already graded successfully in `output_path` are skipped,
+    so an interrupted run can be resumed by running the same command again. When the run
+    finishes, `output_path` is compacted to the latest record per submission.
+    """
+    questions = load_paper(paper_path)
+    submissions = collect_submissions(attempts_dir, questions)
+    completed = load_completed(output_path)
+    pending = [s for s in submissions
+               if (s["student_id"], s["question_id"]) not in completed]
+
+    print(f"Found {len(submissions)} submissions, {len(completed)} already graded, "
+          f"{len(pending)} to grade.")
+    if not pending:
+        return {"graded": 0, "errors": 0, "seconds": 0.0, "total_cost_usd": 0.0}
+
+    start = time.perf_counter()
+
+    # 1. Retrieve textbook pages once per question and share them across students.
+    # Submissions for a question whose lookup failed are recorded as errors for the next run.
+    question_ids = sorted({s["question_id"] for s in pending})
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        retrieved = executor.map(lambda q_id: retrieve_pages(questions[q_id], client), question_ids)
+        pages_by_question = dict(zip(question_ids, retrieved))
+    for q_id, pages in pages_by_question.items():
+        if isinstance(pages, Exception):
+            print(f"Error finding relevant pages for {q_id}: {pages}")
+
+    # 2. Grade submissions concurrently, appending each result as soon as it is ready.
+    # Only max_workers jobs are queued at a time, so stopping the run (Ctrl-C) does not
+    # leave the rest of the class queued up to be sent to the API before exiting.
+    graded, errors, total_cost = 0, 0, 0.0
+    if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+        with open(output_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            ends_with_newline = f.read(1) == b"\n"
+        if not ends_with_newline:
+            # Terminate a partially written last line so new results start on a fresh line
+            with open(output_path, "a") as f:
+                f.write("\n")
+
+    remaining = iter(pending)
+    in_flight = {}
+    with open(output_path, "a") as out, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def submit_next():
+            submission = next(remaining, None)
+            if submission is not None:
+                future = executor.submit(
+                    grade_submission, submission, questions[submission["question_id"]],
+                    pages_by_question[submission["question_id"]], client, price_per_million_tokens,
+                )
+                in_flight[future] = submission
+
+        def write_result(future):
+            nonlocal graded, errors, total_cost
+            submission = in_flight.pop(future)
+            try:
+                record = future.result()
+            except Exception as e:
+                record = {
+                    "student_id": submission["student_id"],
+                    "question_id": submission["question_id"],
+                    "image_path": submission["image_path"],
+                    "status": "error",
+                    "feedback": f"Error grading submission: {e}",
+                }
+
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+
+            if record["status"] == "ok":
+                graded += 1
+                total_cost += record["cost_usd"]
+            else:
+                errors += 1
+            print(f"[{graded + errors}/{len(pending)}] {record['student_id']} "
+                  f"{record['question_id']}: {record['status']}")
+
+        for _ in range(max_workers):
+            submit_next()
+
+        try:
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    write_result(future)
+                    submit_next()
+        except KeyboardInterrupt:
+            # Requests already sent are paid for, so keep their feedback rather than
+            # re-sending them on resume. Nothing new is submitted.
+            print(f"Interrupted: saving {len(in_flight)} submissions already being graded...")
+            for future in list(in_flight):
+                if future.cancel():
+                    in_flight.pop(future)
+                else:
+                    write_result(future)
+            raise
+
+    elapsed = time.perf_counter() - start
+    compact_results(output_path)
+    summary = {
+        "graded": graded,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "total_cost_usd": total_cost,
+    }
+
+    # --- REPORT ---
+    print(f"Graded {graded} submissions ({errors} errors) in {elapsed:.1f}s.")
+    if elapsed > 0:
+        print(f"Throughput: {(graded + errors) / elapsed * 60:.1f} submissions/minute")
+    if graded:
+        print(f"Chat cost (excludes retrieval embeddings): ${total_cost:.4f} total, "
+              f"${total_cost / graded:.5f} per submission")
+    print(f"Results saved to: {output_path}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Batch-grade a class's scanned attempts against a processed exam paper."
+    )
+    parser.add_argument("paper", help="Paper JSON from data/processed, e.g. data/processed/2025_HL_paper1.json")
+    parser.add_argument("attempts_dir", help="Directory laid out as <student_id>/<question_id>.png")
+    parser.add_argument("-o", "--output", default="batch_results.jsonl",
+                        help="JSONL file to stream results to (also used to resume a run)")
+    parser.add_argument("-j", "--workers", type=int, default=4,
+                        help="Maximum number of concurrent Mistral requests")
+    parser.add_argument("--price-per-million", type=float, default=DEFAULT_PRICE_PER_MILLION_TOKENS,
+                        help="USD per million Pixtral chat tokens used to estimate cost "
+                             "(the per-question mistral-embed retrieval calls are not counted)")
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    client = get_mistral_client()
+    run_batch(args.paper, args.attempts_dir, args.output, client,
+              max_workers=args.workers, price_per_million_tokens=args.price_per_million)
+
+
+if __name__ == "__main__":
+    main()
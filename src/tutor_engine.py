@@ -30,7 +30,7 @@ except Exception as e:
     print(f"Warning: Vector store not found or could not be loaded ({e}). Running without RAG.")
 
 # --- RAG RETRIEVAL FUNCTION ---
-def find_relevant_pages(query_text, client, top_k=3):
+def find_relevant_pages(query_text, client, top_k=3, raise_errors=False):
     if textbook_vectors is None or textbook_metadata is None:
         return []
 
@@ -52,21 +52,34 @@ def find_relevant_pages(query_text, client, top_k=3):
         return relevant_pages
 
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"Error finding relevant pages: {e}")
         return []
 
 # --- CORE TUTORING FUNCTION ---
-def get_ai_feedback(image, question_text, client):
+def build_retrieval_query(question_text):
+    """Builds the text used to look up textbook pages for a question."""
+    return f"Question: {question_text}\n\nStudent's attempt: [Image analysis]"
+
+def get_ai_feedback(image, question_text, client, relevant_pages=None, return_usage=False,
+                    raise_errors=False):
     """
     Converts image to base64, finds relevant textbook pages, and fetches Socratic feedback.
+
+    Pass `relevant_pages` to reuse pages already retrieved for this question instead of
+    embedding the query again. With `return_usage=True` the token usage of the chat call
+    is returned as a third value (None if the call failed). With `raise_errors=True` API
+    errors are raised to the caller instead of being returned as feedback text.
     """
     buffered = io.BytesIO()
     image.save(buffered, format="PNG")
     img_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
 
-    # 1. Find relevant textbook pages
-    query_for_retrieval = f"Question: {question_text}\n\nStudent's attempt: [Image analysis]"
-    relevant_pages = find_relevant_pages(query_for_retrieval, client)
+    # 1. Find relevant textbook pages (unless the caller already has them)
+    if relevant_pages is None:
+        relevant_pages = find_relevant_pages(build_retrieval_query(question_text), client,
+                                             raise_errors=raise_errors)
 
     # 2. Build the context for the prompt
     context_str = ""
@@ -116,10 +129,20 @@ def get_ai_feedback(image, question_text, client):
             max_tokens=700,
         )
         feedback = response.choices[0].message.content
+        if return_usage:
+            usage = response.usage
+            return feedback, relevant_pages, {
+                "prompt_tokens": usage.prompt_tokens,
+                "completion_tokens": usage.completion_tokens,
+            }
         return feedback, relevant_pages # Return pages for display in the app
 
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"Mistral API Error: {e}")
+        if return_usage:
+            return f"Error getting AI feedback: {str(e)}", [], None
         return f"Error getting AI feedback: {str(e)}", []
 
 
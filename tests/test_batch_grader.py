@@ -0,0 +1,227 @@
+import pytest
+from unittest.mock import MagicMock, patch
+from PIL import Image
+import os
+import json
+from concurrent.futures import wait as real_wait
+
+# Add the src directory to the Python path
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.batch_grader import run_batch, load_paper, collect_submissions, load_completed
+
+class MockAPIError(Exception):
+    """Stands in for a Mistral SDK error carrying an HTTP status code."""
+    def __init__(self, status_code):
+        super().__init__(f"API error {status_code}")
+        self.status_code = status_code
+
+@pytest.fixture
+def mock_mistral_client():
+    """Create a mock Mistral client that reports token usage."""
+    mock_client = MagicMock()
+    mock_chat_response = MagicMock()
+    mock_chat_response.choices[0].message.content = "This is a mock feedback."
+    mock_chat_response.usage.prompt_tokens = 1000
+    mock_chat_response.usage.completion_tokens = 200
+    mock_client.chat.complete.return_value = mock_chat_response
+
+    mock_embeddings_response = MagicMock()
+    mock_embeddings_response.data[0].embedding = [0.1] * 1024
+    mock_client.embeddings.create.return_value = mock_embeddings_response
+    return mock_client
+
+@pytest.fixture
+def class_submissions(tmp_path):
+    """Create a paper JSON and an attempts directory with two students."""
+    paper = {
+        "title": "Test Paper",
+        "questions": [
+            {"id": "q1", "topic": "Algebra", "text": "Solve $x + 1 = 2$"},
+            {"id": "q2a_i", "topic": "Calculus", "text": "Differentiate $x^2$"},
+        ],
+    }
+    paper_path = tmp_path / "paper.json"
+    paper_path.write_text(json.dumps(paper))
+
+    attempts_dir = tmp_path / "attempts"
+    for student in ["alice", "bob"]:
+        (attempts_dir / student).mkdir(parents=True)
+        for q_id in ["q1", "q2a_i"]:
+            Image.new('RGB', (60, 30), color='white').save(attempts_dir / student / f"{q_id}.png")
+    # An image that does not match any question should be ignored
+    Image.new('RGB', (60, 30), color='white').save(attempts_dir / "bob" / "q9.png")
+
+    return str(paper_path), str(attempts_dir), str(tmp_path / "results.jsonl")
+
+
+def test_load_paper_numbers_repeated_ids(tmp_path):
+    """Test that parts sharing a question id are numbered instead of overwritten."""
+    paper = {
+        "questions": [
+            {"id": "q1", "text": "Part (a)"},
+            {"id": "q1", "text": "Part (b)"},
+            {"id": "q1", "text": "Part (c)"},
+            {"id": "q2", "text": "Only part"},
+        ],
+    }
+    paper_path = tmp_path / "paper.json"
+    paper_path.write_text(json.dumps(paper))
+
+    questions = load_paper(str(paper_path))
+
+    assert list(questions) == ["q1_1", "q1_2", "q1_3", "q2"]
+    assert questions["q1_1"]["text"] == "Part (a)"
+    assert questions["q1_3"]["text"] == "Part (c)"
+
+def test_collect_submissions(class_submissions):
+    """Test that attempts are matched to question ids in the paper."""
+    paper_path, attempts_dir, _ = class_submissions
+    # A second image for the same question should not be graded twice
+    Image.new('RGB', (60, 30), color='white').save(os.path.join(attempts_dir, "alice", "q1.jpg"))
+    questions = {"q1": {}, "q2a_i": {}}
+    submissions = collect_submissions(attempts_dir, questions)
+
+    assert len(submissions) == 4
+    assert {s["question_id"] for s in submissions} == {"q1", "q2a_i"}
+    assert len({(s["student_id"], s["question_id"]) for s in submissions}) == 4
+
+def test_run_batch_shares_retrieval(mock_mistral_client, class_submissions):
+    """Test that every submission is graded and retrieval runs once per question."""
+    paper_path, attempts_dir, output_path = class_submissions
+    with patch('src.batch_grader.find_relevant_pages', return_value=[]) as mock_find:
+        summary = run_batch(paper_path, attempts_dir, output_path, mock_mistral_client, max_workers=2)
+
+    assert mock_find.call_count == 2
+
+    assert summary["graded"] == 4
+    assert summary["errors"] == 0
+    assert summary["total_cost_usd"] == pytest.approx(4 * 1200 * 0.15 / 1_000_000)
+    assert mock_mistral_client.chat.complete.call_count == 4
+
+    with open(output_path) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 4
+    assert all(r["feedback"] == "This is a mock feedback." for r in records)
+
+def test_run_batch_resumes(mock_mistral_client, class_submissions):
+    """Test that a second run skips submissions already in the results file."""
+    paper_path, attempts_dir, output_path = class_submissions
+    with open(output_path, "w") as f:
+        f.write(json.dumps({"student_id": "alice", "question_id": "q1", "status": "ok"}) + "\n")
+        f.write(json.dumps({"student_id": "bob", "question_id": "q1", "status": "error"}) + "\n")
+        f.write('{"student_id": "bob", "quest')  # interrupted write
+
+    assert load_completed(output_path) == {("alice", "q1")}
+
+    with patch('src.tutor_engine.textbook_vectors', None), \
+         patch('src.tutor_engine.textbook_metadata', None):
+        summary = run_batch(paper_path, attempts_dir, output_path, mock_mistral_client)
+
+    assert summary["graded"] == 3
+    assert mock_mistral_client.chat.complete.call_count == 3
+    assert load_completed(output_path) == {("alice", "q1"), ("alice", "q2a_i"), ("bob", "q1"), ("bob", "q2a_i")}
+
+    # bob's earlier error record is replaced by the new result
+    with open(output_path) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 4
+    assert all(r["status"] == "ok" for r in records)
+
+def test_run_batch_stops_early(mock_mistral_client, class_submissions):
+    """Test that Ctrl-C saves the submission being graded and sends no new ones."""
+    paper_path, attempts_dir, output_path = class_submissions
+    calls = []
+
+    def interrupt_second_wait(futures, return_when):
+        calls.append(return_when)
+        if len(calls) == 2:
+            # Let the request already sent finish, as it would while Ctrl-C is handled
+            real_wait(futures)
+            raise KeyboardInterrupt()
+        return real_wait(futures, return_when=return_when)
+
+    with patch('src.batch_grader.find_relevant_pages', return_value=[]), \
+         patch('src.batch_grader.wait', side_effect=interrupt_second_wait), \
+         pytest.raises(KeyboardInterrupt):
+        run_batch(paper_path, attempts_dir, output_path, mock_mistral_client, max_workers=1)
+
+    # The first result was written, then the one in flight at Ctrl-C was saved too
+    assert mock_mistral_client.chat.complete.call_count == 2
+    with open(output_path) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 2
+    assert all(r["status"] == "ok" for r in records)
+
+def test_run_batch_retries_transient_errors(mock_mistral_client, class_submissions):
+    """Test that a failed chat call is retried before being recorded as an error."""
+    paper_path, attempts_dir, output_path = class_submissions
+    mock_chat_response = mock_mistral_client.chat.complete.return_value
+    mock_mistral_client.chat.complete.side_effect = [MockAPIError(429)] + [mock_chat_response] * 4
+
+    with patch('src.batch_grader.find_relevant_pages', return_value=[]), \
+         patch('src.batch_grader.RETRY_BACKOFF_SECONDS', 0):
+        summary = run_batch(paper_path, attempts_dir, output_path, mock_mistral_client, max_workers=1)
+
+    assert summary["graded"] == 4
+    assert summary["errors"] == 0
+    assert mock_mistral_client.chat.complete.call_count == 5
+
+def test_run_batch_records_errors(mock_mistral_client, class_submissions):
+    """Test that submissions which keep failing are recorded as errors and retried next run."""
+    paper_path, attempts_dir, output_path = class_submissions
+    mock_mistral_client.chat.complete.side_effect = MockAPIError(503)
+
+    with patch('src.batch_grader.find_relevant_pages', return_value=[]), \
+         patch('src.batch_grader.RETRY_BACKOFF_SECONDS', 0):
+        summary = run_batch(paper_path, attempts_dir, output_path, mock_mistral_client)
+
+    assert summary["graded"] == 0
+    assert summary["errors"] == 4
+    assert mock_mistral_client.chat.complete.call_count == 4 * 4
+
+    with open(output_path) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 4
+    assert all(r["status"] == "error" for r in records)
+    assert load_completed(output_path) == set()
+
+def test_run_batch_does_not_retry_permanent_errors(mock_mistral_client, class_submissions):
+    """Test that errors such as a bad API key are not retried."""
+    paper_path, attempts_dir, output_path = class_submissions
+    mock_mistral_client.chat.complete.side_effect = MockAPIError(401)
+
+    with patch('src.batch_grader.find_relevant_pages', return_value=[]):
+        summary = run_batch(paper_path, attempts_dir, output_path, mock_mistral_client)
+
+    assert summary["errors"] == 4
+    assert mock_mistral_client.chat.complete.call_count == 4
+
+def test_run_batch_retries_retrieval(mock_mistral_client, class_submissions):
+    """Test that a failed textbook lookup is retried and otherwise marks its submissions as errors."""
+    paper_path, attempts_dir, output_path = class_submissions
+    pages = [{"page_number": 7, "text": "Page 7", "image_paths": []}]
+
+    def find_pages(query_text, client, raise_errors=False):
+        if "Differentiate" in query_text:
+            raise MockAPIError(503)
+        if not find_pages.failed_once:
+            find_pages.failed_once = True
+            raise MockAPIError(429)
+        return pages
+    find_pages.failed_once = False
+
+    with patch('src.batch_grader.find_relevant_pages', side_effect=find_pages), \
+         patch('src.batch_grader.RETRY_BACKOFF_SECONDS', 0):
+        summary = run_batch(paper_path, attempts_dir, output_path, mock_mistral_client)
+
+    assert summary["graded"] == 2
+    assert summary["errors"] == 2
+    assert mock_mistral_client.chat.complete.call_count == 2
+
+    with open(output_path) as f:
+        records = {r["student_id"] + "/" + r["question_id"]: r for r in map(json.loads, f)}
+    assert records["alice/q1"]["pages"] == [7]
+    assert records["alice/q2a_i"]["status"] == "error"
+    assert load_completed(output_path) == {("alice", "q1"), ("bob", "q1")}